@@ -2,37 +2,100 @@ import os
 import shutil
 import tempfile
 import contextlib
+import collections
+import atexit
+import itertools
 import unittest
-import argparse
 import sys
 import torch
-import errno
+import json
+import struct
+import numpy as np
 import __main__
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+
+def _copytree(src, dst, link=False):
+    # with link=True the files are hard linked instead of copied, so writing
+    # to them also modifies src
+    if link and sys.version_info >= (3,) and hasattr(os, "link"):
+        try:
+            shutil.copytree(src, dst, copy_function=os.link)
+            return
+        except (OSError, shutil.Error):
+            # e.g. EXDEV if src and dst are on different devices
+            shutil.rmtree(dst, ignore_errors=True)
+    shutil.copytree(src, dst)
+
+
+_TMP_BASE = None
+_TMP_COUNTER = itertools.count()
+# removing a directory tree does not need to block the test that used it
+_CLEANUP_POOL = ThreadPoolExecutor(max_workers=2) if ThreadPoolExecutor is not None else None
+
+
+def _remove_tmp_dir(tmp_dir):
+    if _CLEANUP_POOL is None:
+        shutil.rmtree(tmp_dir)
+    else:
+        _CLEANUP_POOL.submit(shutil.rmtree, tmp_dir, ignore_errors=True)
+
+
+@atexit.register
+def _remove_tmp_base():
+    # wait for pending removals before deleting the base they live in
+    if _CLEANUP_POOL is not None:
+        _CLEANUP_POOL.shutdown(wait=True)
+    if _TMP_BASE is not None:
+        shutil.rmtree(_TMP_BASE, ignore_errors=True)
+
+
+def _new_tmp_dir_path():
+    # one randomly named base directory per process; the directories handed
+    # out by get_tmp_dir are numbered inside of it (the pid keeps forked
+    # workers from colliding)
+    global _TMP_BASE
+    if _TMP_BASE is None:
+        _TMP_BASE = tempfile.mkdtemp(prefix="vision_tests_")
+    return os.path.join(_TMP_BASE, "{}_{}".format(os.getpid(), next(_TMP_COUNTER)))
+
 
 @contextlib.contextmanager
-def get_tmp_dir(src=None, **kwargs):
-    tmp_dir = tempfile.mkdtemp(**kwargs)
+def get_tmp_dir(src=None, link=False, **kwargs):
+    r"""
+    Create a temporary directory, optionally populated with a copy of
+    ``src``, and remove it on exit. Pass ``link=True`` to hard link the files
+    of ``src`` instead of copying them; only do so if the caller never writes
+    to them.
+    """
+    if kwargs:
+        # prefix / suffix / dir need a directory of their own
+        tmp_dir = tempfile.mkdtemp(**kwargs)
+        if src is not None:
+            os.rmdir(tmp_dir)
+    else:
+        tmp_dir = _new_tmp_dir_path()
+        if src is None:
+            os.mkdir(tmp_dir)
     if src is not None:
-        os.rmdir(tmp_dir)
-        shutil.copytree(src, tmp_dir)
+        _copytree(src, tmp_dir, link=link)
     try:
         yield tmp_dir
     finally:
-        shutil.rmtree(tmp_dir)
+        _remove_tmp_dir(tmp_dir)
 
 
 ACCEPT = os.getenv('EXPECTTEST_ACCEPT')
 
-parser = argparse.ArgumentParser(add_help=False)
-parser.add_argument('--accept', action='store_true')
-args, remaining = parser.parse_known_args()
-if not ACCEPT:
-    ACCEPT = args.accept
-for i, arg in enumerate(sys.argv):
-    if arg == '--accept':
-        del sys.argv[i]
-        break
+# --accept has to be removed from sys.argv before unittest.main() parses it,
+# so it is looked up directly instead of building an argparse parser
+if '--accept' in sys.argv:
+    sys.argv.remove('--accept')
+    ACCEPT = True
 
 
 class MapNestedTensorObjectImpl(object):
@@ -40,20 +103,18 @@ class MapNestedTensorObjectImpl(object):
         self.tensor_map_fn = tensor_map_fn
 
     def __call__(self, object):
+        fn = self.tensor_map_fn
         if isinstance(object, torch.Tensor):
-            return self.tensor_map_fn(object)
+            return fn(object)
 
         elif isinstance(object, dict):
-            mapped_dict = {}
-            for key, value in object.items():
-                mapped_dict[self(key)] = self(value)
-            return mapped_dict
+            return {self(key): self(value) for key, value in object.items()}
 
-        elif isinstance(object, (list, tuple)):
-            mapped_iter = []
-            for iter in object:
-                mapped_iter.append(self(iter))
-            return mapped_iter if not isinstance(object, tuple) else tuple(mapped_iter)
+        elif isinstance(object, list):
+            return [self(iter) for iter in object]
+
+        elif isinstance(object, tuple):
+            return tuple([self(iter) for iter in object])
 
         else:
             return object
@@ -64,6 +125,174 @@ def map_nested_tensor_object(object, tensor_map_fn):
     return impl(object)
 
 
+# dtypes that round-trip through numpy and can be stored as raw buffers,
+# mapped to their safetensors dtype code; data is always little-endian
+_RAW_TENSOR_DTYPES = {
+    torch.bool: "BOOL",
+    torch.uint8: "U8",
+    torch.int8: "I8",
+    torch.int16: "I16",
+    torch.int32: "I32",
+    torch.int64: "I64",
+    torch.float16: "F16",
+    torch.float32: "F32",
+    torch.float64: "F64",
+}
+_RAW_NUMPY_DTYPES = {
+    "BOOL": np.dtype("|b1"),
+    "U8": np.dtype("|u1"),
+    "I8": np.dtype("|i1"),
+    "I16": np.dtype("<i2"),
+    "I32": np.dtype("<i4"),
+    "I64": np.dtype("<i8"),
+    "F16": np.dtype("<f2"),
+    "F32": np.dtype("<f4"),
+    "F64": np.dtype("<f8"),
+}
+_RAW_TENSOR_KEY = "__tensor__"
+
+
+def _is_raw_tensor(tensor):
+    # subclasses such as nn.Parameter and non-CPU tensors would not reload as
+    # the same type / on the same device, so they are left to torch.save
+    return (type(tensor) is torch.Tensor and tensor.layout == torch.strided and
+            tensor.device.type == "cpu" and tensor.dtype in _RAW_TENSOR_DTYPES)
+
+
+def _is_raw_tensor_object(object):
+    if type(object) is dict:
+        return all(isinstance(key, str) and key != _RAW_TENSOR_KEY and _is_raw_tensor(value)
+                   for key, value in object.items())
+    return _is_raw_tensor(object)
+
+
+def _save_raw_tensors(object, f):
+    r"""
+    Write a tensor, or a flat dict of tensors keyed by strings, using the
+    safetensors layout: an 8-byte little-endian header length, a JSON header
+    mapping each name to its dtype, shape and data offsets padded with spaces
+    to a multiple of 8 bytes, followed by the concatenated raw tensor bytes.
+    """
+    tensors = {_RAW_TENSOR_KEY: object} if type(object) is torch.Tensor else object
+    header = {}
+    buffers = []
+    offset = 0
+    # larger items first keeps every tensor aligned to its item size
+    for name in sorted(tensors, key=lambda name: (-tensors[name].element_size(), name)):
+        tensor = tensors[name]
+        code = _RAW_TENSOR_DTYPES[tensor.dtype]
+        array = tensor.detach().contiguous().numpy().astype(_RAW_NUMPY_DTYPES[code], copy=False)
+        data = array.tobytes()
+        header[name] = {
+            "dtype": code,
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + len(data)],
+        }
+        buffers.append(data)
+        offset += len(data)
+    header = json.dumps(header).encode("utf-8")
+    # pad with spaces so the data starts 8-byte aligned, as safetensors does
+    header += b" " * (-len(header) % 8)
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
+    for data in buffers:
+        f.write(data)
+
+
+def _load_raw_tensors(path):
+    r"""
+    Read a file written by `_save_raw_tensors`. The file is read in one go
+    and the tensors are wrapped around that buffer without further copies.
+    """
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    header_size, = struct.unpack("<Q", bytes(data[:8]))
+    header = json.loads(bytes(data[8:8 + header_size]).decode("utf-8"))
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        dtype = _RAW_NUMPY_DTYPES[info["dtype"]]
+        shape = tuple(info["shape"])
+        start, end = info["data_offsets"]
+        if end > start:
+            array = np.frombuffer(data, dtype=dtype, count=(end - start) // dtype.itemsize,
+                                  offset=data_start + start).reshape(shape)
+        else:
+            # frombuffer rejects an offset at the very end of the buffer
+            array = np.empty(shape, dtype=dtype)
+        tensors[name] = torch.from_numpy(array)
+    if _RAW_TENSOR_KEY in tensors:
+        return tensors[_RAW_TENSOR_KEY]
+    return tensors
+
+
+# os.replace is Python 3 only; os.rename also overwrites on POSIX
+_replace_file = getattr(os, "replace", os.rename)
+
+
+# path -> (mtime, value), least recently used first; shared by every test so
+# that subtests reading the same expect file decode it only once
+_EXPECTED_CACHE = collections.OrderedDict()
+_EXPECTED_CACHE_SIZE = 256
+
+
+def _load_expected(path):
+    # one stat per call, so an expect file changed on disk is reloaded
+    mtime = os.stat(path).st_mtime
+    cached = _EXPECTED_CACHE.pop(path, None)
+    if cached is None or cached[0] != mtime:
+        load = _load_raw_tensors if path.endswith(".safetensors") else torch.load
+        cached = (mtime, load(path))
+        while len(_EXPECTED_CACHE) >= _EXPECTED_CACHE_SIZE:
+            _EXPECTED_CACHE.popitem(last=False)
+    _EXPECTED_CACHE[path] = cached
+    return cached[1]
+
+
+# expect directory -> {file name: path}; each directory is listed once
+# instead of probing the filesystem for every expect file
+_EXPECT_DIR_CACHE = {}
+
+
+def _list_expect_dir(expect_dir):
+    listing = _EXPECT_DIR_CACHE.get(expect_dir)
+    if listing is None:
+        listing = {}
+        if hasattr(os, "scandir") and os.path.isdir(expect_dir):
+            for entry in os.scandir(expect_dir):
+                listing[entry.name] = entry.path
+        elif os.path.isdir(expect_dir):
+            for name in os.listdir(expect_dir):
+                listing[name] = os.path.join(expect_dir, name)
+        _EXPECT_DIR_CACHE[expect_dir] = listing
+    return listing
+
+
+# marks stack entries of assertNestedTensorObjectsEqual that are not dict entries
+_NO_KEY = object()
+
+
+# (module id, test id) -> (expect directory, munged test id)
+_EXPECT_PATHS_CACHE = {}
+
+
+def _expect_paths(module_id, test_id):
+    def remove_prefix(text, prefix):
+        if text.startswith(prefix):
+            return text[len(prefix):]
+        return text
+    key = (module_id, test_id)
+    if key not in _EXPECT_PATHS_CACHE:
+        # NB: we take __file__ from the module that defined the test
+        # class, so we place the expect directory where the test script
+        # lives, NOT where test/common_utils.py lives.
+        munged_id = remove_prefix(test_id, module_id + ".")
+        test_file = os.path.realpath(sys.modules[module_id].__file__)
+        expect_dir = os.path.join(os.path.dirname(test_file), "expect")
+        _EXPECT_PATHS_CACHE[key] = (expect_dir, munged_id)
+    return _EXPECT_PATHS_CACHE[key]
+
+
 # adapted from TestCase in torch/test/common_utils to accept non-string
 # inputs and set maximum binary size
 class TestCase(unittest.TestCase):
@@ -76,49 +305,67 @@ class TestCase(unittest.TestCase):
         as the test script. You can automatically update the recorded test
         output using --accept.
 
+        Tensors and flat dicts of tensors are recorded as raw buffers in a
+        `_expect.safetensors` file; any other value is recorded in a
+        `_expect.pkl` file with `torch.save`.
+
         If you call this multiple times in a single function, you must
         give a unique subname each time.
         """
-        def remove_prefix(text, prefix):
-            if text.startswith(prefix):
-                return text[len(prefix):]
-            return text
-        # NB: we take __file__ from the module that defined the test
-        # class, so we place the expect directory where the test script
-        # lives, NOT where test/common_utils.py lives.
-        module_id = self.__class__.__module__
-        munged_id = remove_prefix(self.id(), module_id + ".")
-        test_file = os.path.realpath(sys.modules[module_id].__file__)
-        expected_file = os.path.join(os.path.dirname(test_file),
-                                     "expect",
-                                     munged_id)
+        expect_dir, munged_id = _expect_paths(self.__class__.__module__, self.id())
+        expected_name = munged_id
 
         subname_output = ""
         if subname:
-            expected_file += "_" + subname
+            expected_name += "_" + subname
             subname_output = " ({})".format(subname)
-        expected_file += "_expect.pkl"
+        raw_name = expected_name + "_expect.safetensors"
+        pickle_name = expected_name + "_expect.pkl"
         expected = None
 
         def accept_output(update_type):
             print("Accepting {} for {}{}:\n\n{}".format(update_type, munged_id, subname_output, output))
-            torch.save(output, expected_file)
+            raw = _is_raw_tensor_object(output)
+            output_file = os.path.join(expect_dir, raw_name if raw else pickle_name)
+            stale_name = pickle_name if raw else raw_name
+            # write next to the expect file and move it into place, so an
+            # interrupted run never leaves a truncated expect file behind
+            tmp_file = output_file + ".tmp"
+            # drop the cached value before the file underneath it is replaced
+            _EXPECTED_CACHE.pop(output_file, None)
+            try:
+                with open(tmp_file, "wb") as f:
+                    if raw:
+                        _save_raw_tensors(output, f)
+                    else:
+                        torch.save(output, f)
+                    f.flush()
+                    binary_size = os.fstat(f.fileno()).st_size
+                _replace_file(tmp_file, output_file)
+            except BaseException:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                raise
+            if stale_name in listing:
+                _EXPECTED_CACHE.pop(listing[stale_name], None)
+                os.remove(listing[stale_name])
+            _EXPECT_DIR_CACHE.pop(expect_dir, None)
             MAX_PICKLE_SIZE = 50 * 1000  # 50 KB
-            binary_size = os.path.getsize(expected_file)
             self.assertTrue(binary_size <= MAX_PICKLE_SIZE)
 
-        try:
-            expected = torch.load(expected_file)
-        except IOError as e:
-            if e.errno != errno.ENOENT:
-                raise
-            elif ACCEPT:
-                return accept_output("output")
-            else:
-                raise RuntimeError(
-                    ("I got this output for {}{}:\n\n{}\n\n"
-                     "No expect file exists; to accept the current output, run:\n"
-                     "python {} {} --accept").format(munged_id, subname_output, output, __main__.__file__, munged_id))
+        listing = _list_expect_dir(expect_dir)
+        if raw_name in listing:
+            expected_file = listing[raw_name]
+        elif pickle_name in listing:
+            expected_file = listing[pickle_name]
+        elif ACCEPT:
+            return accept_output("output")
+        else:
+            raise RuntimeError(
+                ("I got this output for {}{}:\n\n{}\n\n"
+                 "No expect file exists; to accept the current output, run:\n"
+                 "python {} {} --accept").format(munged_id, subname_output, output, __main__.__file__, munged_id))
+        expected = _load_expected(expected_file)
 
         if ACCEPT:
             equal = False
@@ -132,22 +379,31 @@ class TestCase(unittest.TestCase):
             self.assertNestedTensorObjectsEqual(output, expected, rtol=rtol, atol=atol)
 
     def assertNestedTensorObjectsEqual(self, a, b, rtol=None, atol=None):
-        self.assertEqual(type(a), type(b))
-
-        if isinstance(a, torch.Tensor):
-            torch.testing.assert_allclose(a, b, rtol=rtol, atol=atol)
-
-        elif isinstance(a, dict):
-            self.assertEqual(len(a), len(b))
-            for key, value in a.items():
+        # walk both objects with an explicit stack instead of one recursive
+        # call per node. Dict entries are pushed as (a, b, key) and their key
+        # is checked when popped; together with pushing children in reverse
+        # this reports mismatches in the same order as a recursive walk
+        stack = [(a, b, _NO_KEY)]
+        while stack:
+            a, b, key = stack.pop()
+            if key is not _NO_KEY:
                 self.assertTrue(key in b, "key: " + str(key))
+                a, b = a[key], b[key]
+            self.assertEqual(type(a), type(b))
 
-                self.assertNestedTensorObjectsEqual(value, b[key], rtol=rtol, atol=atol)
-        elif isinstance(a, (list, tuple)):
-            self.assertEqual(len(a), len(b))
+            if isinstance(a, torch.Tensor):
+                # bitwise identical tensors need no tolerance check
+                if a.dtype == b.dtype and a.device == b.device and torch.equal(a, b):
+                    continue
+                torch.testing.assert_allclose(a, b, rtol=rtol, atol=atol)
 
-            for val1, val2 in zip(a, b):
-                self.assertNestedTensorObjectsEqual(val1, val2, rtol=rtol, atol=atol)
+            elif isinstance(a, dict):
+                self.assertEqual(len(a), len(b))
+                stack.extend(reversed([(a, b, key) for key in a]))
 
-        else:
-            self.assertEqual(a, b)
+            elif isinstance(a, (list, tuple)):
+                self.assertEqual(len(a), len(b))
+                stack.extend(reversed([(val1, val2, _NO_KEY) for val1, val2 in zip(a, b)]))
+
+            else:
+                self.assertEqual(a, b)
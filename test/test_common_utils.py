@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import shutil
+import struct
+import tempfile
+import types
+import numpy as np
+import torch
+import unittest
+
+import common_utils
+from common_utils import TestCase, get_tmp_dir, _is_raw_tensor_object, _save_raw_tensors, _load_raw_tensors
+
+
+class Tester(unittest.TestCase):
+
+    def _round_trip(self, object):
+        with get_tmp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, "tensors_expect.safetensors")
+            with open(path, "wb") as f:
+                _save_raw_tensors(object, f)
+            return _load_raw_tensors(path)
+
+    def _assert_round_trip(self, tensor):
+        self.assertTrue(_is_raw_tensor_object(tensor))
+        loaded = self._round_trip(tensor)
+        self.assertIs(type(loaded), torch.Tensor)
+        self.assertEqual(loaded.dtype, tensor.dtype)
+        self.assertEqual(loaded.shape, tensor.shape)
+        self.assertTrue(np.array_equal(loaded.numpy(), tensor.numpy()))
+
+    def test_raw_tensors_dtypes(self):
+        self._assert_round_trip(torch.rand(3, 4))
+        self._assert_round_trip(torch.rand(3, 4, dtype=torch.float64))
+        self._assert_round_trip(torch.rand(3, 4).half())
+        self._assert_round_trip(torch.randint(0, 255, (5,), dtype=torch.uint8))
+        self._assert_round_trip(torch.randint(-100, 100, (5,), dtype=torch.int8))
+        self._assert_round_trip(torch.randint(-100, 100, (5,), dtype=torch.int16))
+        self._assert_round_trip(torch.randint(-100, 100, (5,), dtype=torch.int32))
+        self._assert_round_trip(torch.randint(-100, 100, (5,), dtype=torch.int64))
+        self._assert_round_trip(torch.tensor([True, False, True]))
+
+    def test_raw_tensors_shapes(self):
+        self._assert_round_trip(torch.tensor(3.5))
+        self._assert_round_trip(torch.empty(0))
+        self._assert_round_trip(torch.empty(2, 0, 3))
+        self._assert_round_trip(torch.rand(4, 5).t())
+        self._assert_round_trip(torch.rand(6, 6)[::2, 1::3])
+
+    def test_raw_tensors_dict(self):
+        tensors = {
+            "boxes": torch.rand(4, 4),
+            "labels": torch.randint(0, 10, (4,), dtype=torch.int64),
+            "empty": torch.empty(0, 4),
+            "score": torch.tensor(0.5),
+            "keep": torch.tensor([True, False, True]),
+            "ids": torch.arange(3, dtype=torch.int64),
+        }
+        self.assertTrue(_is_raw_tensor_object(tensors))
+        loaded = self._round_trip(tensors)
+        self.assertIs(type(loaded), dict)
+        self.assertEqual(sorted(loaded.keys()), sorted(tensors.keys()))
+        for key, value in tensors.items():
+            self.assertEqual(loaded[key].numpy().ctypes.data % value.element_size(), 0)
+            self.assertEqual(loaded[key].dtype, value.dtype)
+            self.assertEqual(loaded[key].shape, value.shape)
+            self.assertTrue(np.array_equal(loaded[key].numpy(), value.numpy()))
+
+    def test_raw_tensors_header(self):
+        with get_tmp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, "tensors_expect.safetensors")
+            with open(path, "wb") as f:
+                _save_raw_tensors({"a": torch.zeros(2, 3), "b": torch.zeros(4, dtype=torch.bool)}, f)
+            with open(path, "rb") as f:
+                header_size, = struct.unpack("<Q", f.read(8))
+                self.assertEqual(header_size % 8, 0)
+                header = json.loads(f.read(header_size).decode("utf-8"))
+                data_size = len(f.read())
+        self.assertEqual(header["a"], {"dtype": "F32", "shape": [2, 3], "data_offsets": [0, 24]})
+        self.assertEqual(header["b"], {"dtype": "BOOL", "shape": [4], "data_offsets": [24, 28]})
+        self.assertEqual(data_size, 28)
+
+    def test_raw_tensors_unsupported(self):
+        self.assertFalse(_is_raw_tensor_object(torch.nn.Parameter(torch.ones(2))))
+        self.assertFalse(_is_raw_tensor_object({"weight": torch.nn.Parameter(torch.ones(2))}))
+        self.assertFalse(_is_raw_tensor_object([torch.ones(2)]))
+        self.assertFalse(_is_raw_tensor_object({"a": {"b": torch.ones(2)}}))
+        self.assertFalse(_is_raw_tensor_object({1: torch.ones(2)}))
+        self.assertFalse(_is_raw_tensor_object(torch.ones(2).to_sparse()))
+
+    @unittest.skipIf(not torch.cuda.is_available(), "CUDA unavailable")
+    def test_raw_tensors_cuda(self):
+        self.assertFalse(_is_raw_tensor_object(torch.ones(2, device="cuda")))
+
+
+class AssertExpectedTester(unittest.TestCase):
+
+    def setUp(self):
+        # a scratch test module whose expect directory lives in a temporary
+        # directory, so accepting outputs never touches test/expect
+        self.tmp_dir = tempfile.mkdtemp()
+        self.expect_dir = os.path.join(self.tmp_dir, "expect")
+        os.mkdir(self.expect_dir)
+        module = types.ModuleType("expect_scratch_" + os.path.basename(self.tmp_dir))
+        module.__file__ = os.path.join(self.tmp_dir, "test_scratch.py")
+        sys.modules[module.__name__] = module
+
+        class ScratchTester(TestCase):
+            def runTest(self):
+                pass
+        ScratchTester.__module__ = module.__name__
+        ScratchTester.__qualname__ = "ScratchTester"
+        self.module = module
+        self.tester = ScratchTester()
+        self.accept = common_utils.ACCEPT
+
+    def tearDown(self):
+        common_utils.ACCEPT = self.accept
+        del sys.modules[self.module.__name__]
+        shutil.rmtree(self.tmp_dir)
+
+    def _expect(self, output, subname, accept=False):
+        common_utils.ACCEPT = accept
+        self.tester.assertExpected(output, subname=subname)
+
+    def _expect_files(self, subname):
+        prefix = "ScratchTester.runTest_{}_expect".format(subname)
+        return sorted(name for name in os.listdir(self.expect_dir) if name.startswith(prefix))
+
+    def test_accept_and_reload(self):
+        outputs = {
+            "tensor": torch.rand(2, 3),
+            "scalar": torch.tensor(2.0),
+            "dict": {"a": torch.ones(3), "s": torch.tensor(2.0), "ids": torch.arange(4)},
+            "list": [torch.rand(2), {"labels": torch.arange(2)}],
+        }
+        for subname, output in outputs.items():
+            self._expect(output, subname, accept=True)
+        self.assertEqual(self._expect_files("tensor"), ["ScratchTester.runTest_tensor_expect.safetensors"])
+        self.assertEqual(self._expect_files("scalar"), ["ScratchTester.runTest_scalar_expect.safetensors"])
+        self.assertEqual(self._expect_files("dict"), ["ScratchTester.runTest_dict_expect.safetensors"])
+        self.assertEqual(self._expect_files("list"), ["ScratchTester.runTest_list_expect.pkl"])
+
+        for subname, output in outputs.items():
+            self._expect(output, subname)
+        with self.assertRaises(AssertionError):
+            self._expect(torch.zeros(2, 3), "tensor")
+
+    def test_missing_expect_file(self):
+        with self.assertRaises(RuntimeError):
+            self._expect(torch.ones(2), "missing")
+        self.assertEqual(self._expect_files("missing"), [])
+
+    def test_switch_format(self):
+        tensor = torch.ones(2)
+        values = [tensor, [tensor]]
+        self._expect(tensor, "switch", accept=True)
+        self._expect(tensor, "switch")
+
+        self._expect(values, "switch", accept=True)
+        self.assertEqual(self._expect_files("switch"), ["ScratchTester.runTest_switch_expect.pkl"])
+        self._expect(values, "switch")
+        with self.assertRaises(AssertionError):
+            self._expect(tensor, "switch")
+
+        self._expect(tensor, "switch", accept=True)
+        self.assertEqual(self._expect_files("switch"), ["ScratchTester.runTest_switch_expect.safetensors"])
+        self._expect(tensor, "switch")
+
+    def test_reload_changed_file(self):
+        self._expect(torch.ones(2), "changed", accept=True)
+        self._expect(torch.ones(2), "changed")
+
+        # rewrite the expect file behind the cache's back
+        path = os.path.join(self.expect_dir, "ScratchTester.runTest_changed_expect.safetensors")
+        mtime = os.stat(path).st_mtime
+        with open(path, "wb") as f:
+            common_utils._save_raw_tensors(torch.zeros(2), f)
+        os.utime(path, (mtime + 10, mtime + 10))
+        self._expect(torch.zeros(2), "changed")
+
+    def test_unpicklable_output(self):
+        with self.assertRaises(Exception):
+            self._expect([lambda x: x], "unpicklable", accept=True)
+        self.assertEqual(self._expect_files("unpicklable"), [])
+
+
+class NestedTensorObjectsEqualTester(TestCase):
+
+    def test_nested_equal(self):
+        a = {"boxes": [torch.rand(2, 4), {"ids": torch.arange(3)}], "size": (3, 4)}
+        b = {"boxes": [a["boxes"][0].clone(), {"ids": torch.arange(3)}], "size": (3, 4)}
+        self.assertNestedTensorObjectsEqual(a, b)
+
+    def _assert_first_mismatch(self, a, b, message):
+        with self.assertRaises(AssertionError) as cm:
+            self.assertNestedTensorObjectsEqual(a, b)
+        self.assertIn(message, str(cm.exception))
+
+    def test_nested_mismatch_order(self):
+        # the first entry is compared before the key of the second is checked
+        self._assert_first_mismatch({"x": 1, "y": 2}, {"x": 3, "z": 2}, "1 != 3")
+        self._assert_first_mismatch({"y": 2, "x": 1}, {"x": 3, "z": 2}, "key: y")
+        self._assert_first_mismatch([[1], {"y": 2}], [[3], {"z": 2}], "1 != 3")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -37,7 +37,7 @@ class Tester(unittest.TestCase):
         FAKEDATA_DIR = get_file_path_2(
             os.path.dirname(os.path.abspath(__file__)), 'assets', 'fakedata')
 
-        with get_tmp_dir(src=os.path.join(FAKEDATA_DIR, 'imagefolder')) as root:
+        with get_tmp_dir(src=os.path.join(FAKEDATA_DIR, 'imagefolder'), link=True) as root:
             classes = sorted(['a', 'b'])
             class_a_image_files = [os.path.join(root, 'a', file)
                                    for file in ('a1.png', 'a2.png', 'a3.png')]